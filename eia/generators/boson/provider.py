@@ -5,6 +5,7 @@ import json
 from datetime import datetime as datetime_
 from typing import List
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
@@ -27,15 +28,17 @@ STATE_PATH = "/app/states.geoparquet"
 
 
 class Boundaries:
-    def __init__(self, path: str):
-        self.df = gpd.read_parquet(path)
+    def __init__(self, path: str, columns: List[str] = None):
+        self.df = gpd.read_parquet(path, columns=columns)
+        # build the spatial index at load time rather than on the first request
+        self.df.sindex
 
     def intersects(self, geom) -> gpd.GeoDataFrame:
-        idx = self.df.intersects(geom)
-        return self.df.copy().loc[idx]
+        idx = self.df.sindex.query(geom, predicate="intersects")
+        return self.df.iloc[np.sort(idx)]
 
 
-states = Boundaries(STATE_PATH)
+states = Boundaries(STATE_PATH, columns=["STUSPS", "geometry"])
 
 
 class EIAGenerators:
@@ -1,14 +1,22 @@
 import logging
 import requests
 import os
+import threading
 
-from typing import List, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterator, List, Tuple, Union
 from datetime import datetime as _datetime
 import geopandas as gpd
 from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from shapely import geometry
 import urllib.parse
+import numpy as np
+import orjson
 import pandas as pd
+from requests.adapters import HTTPAdapter
 
 from boson import Pagination
 from boson.http import serve
@@ -21,21 +29,43 @@ logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 
 
-STATE_PATH = "/app/states.geoparquet"
 COUNTIES_PATH = "/app/counties.geoparquet"
 
+# Maximum number of API requests that are in flight at once
+MAX_CONCURRENT_REQUESTS = 16
+
+# Seconds to wait on the API before giving up on a request, so a stalled connection can't hold up
+# the whole batch
+REQUEST_TIMEOUT = 60
+
 
 class Boundaries:
-    def __init__(self, path: str):
-        self.df = gpd.read_parquet(path)
+    def __init__(self, path: str, columns: List[str] = None):
+        self.df = gpd.read_parquet(path, columns=columns)
+        if "STATEFP" in self.df.columns:
+            self.df["STATEFP"] = self.df["STATEFP"].str.strip()
+        if "COUNTYNS" in self.df.columns:
+            self.df = self.df.sort_values("COUNTYNS").reset_index(drop=True)
+        # build the spatial index at load time rather than on the first request
+        self.df.sindex
 
     def intersects(self, geom) -> gpd.GeoDataFrame:
-        idx = self.df.intersects(geom)
-        return self.df.copy().loc[idx]
+        idx = self.df.sindex.query(geom, predicate="intersects")
+        return self.df.iloc[np.sort(idx)]
+
+
+# counties are loaded on first use, so workers that never serve a search don't pay for them
+@lru_cache(maxsize=1)
+def _get_counties() -> Boundaries:
+    # every county column is joined into the search results, so nothing is projected away
+    return Boundaries(COUNTIES_PATH)
 
 
-counties = Boundaries(COUNTIES_PATH)
-states = Boundaries(STATE_PATH)
+@lru_cache(maxsize=128)
+def _cql2_to_query_params_cached(filter_json: bytes) -> dict:
+    # filters are dicts, so they're cached on their serialized form. Callers must not modify the
+    # returned params
+    return cql2_to_query_params(orjson.loads(filter_json))
 
 
 class NASSQuickStats:
@@ -44,6 +74,14 @@ class NASSQuickStats:
         self.max_page_size = 50000
         self.api_default_params = {"key": os.getenv("API_KEY")}
 
+        # reuse connections across requests (and threads) instead of a new TLS handshake each time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=MAX_CONCURRENT_REQUESTS, pool_maxsize=MAX_CONCURRENT_REQUESTS
+        )
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+
     def get_counties_from_geometry(self, geom) -> gpd.GeoDataFrame:
         """
         Given a geometry or bbox, return a geodataframe with 'county_name', 'state_name', 'geometry' (county geometry), sorted by 'COUNTYNS'
@@ -64,29 +102,18 @@ class NASSQuickStats:
         elif not isinstance(geom, geometry.base.BaseGeometry):
             raise ValueError("geom must be a shapely geometry or a bbox")
 
+        # shallow copy so callers can't modify the cached frame in place
+        return self._get_counties_intersecting(geom).copy(deep=False)
+
+    @cached(cache=TTLCache(maxsize=512, ttl=3600), key=lambda self, geom: hashkey(geom.wkb))
+    def _get_counties_intersecting(self, geom) -> gpd.GeoDataFrame:
         # get the counties that intersect with the geometry
-        counties_gdf = counties.intersects(geom)
+        counties_gdf = _get_counties().intersects(geom)
         if len(counties_gdf) == 0:
             return gpd.GeoDataFrame(columns=["geometry", "id"])
 
         return counties_gdf
 
-    def get_states_from_geometry(self, geom) -> gpd.GeoDataFrame:
-        """
-        do this later (for when we can only search by state)
-        """
-        if isinstance(geom, list) or isinstance(geom, tuple):
-            if len(geom) != 4:
-                raise ValueError("bbox must be a bounding box with 4 coordinates")
-            geom = geometry.box(*geom)
-
-        elif not isinstance(geom, geometry.base.BaseGeometry):
-            raise ValueError("geom must be a shapely geometry or a bbox")
-
-        # get the states that intersect with the geometry, and drop all except the statefp and name
-        states_df = states.intersects(geom)
-        return states_df
-
     def create_query_list(
         self,
         bbox: List[float] = [],
@@ -115,7 +142,13 @@ class NASSQuickStats:
             geom = geometry.box(-179.9, 18.0, -66.9, 71.4)
 
         counties_gdf = self.get_counties_from_geometry(geom)
-        states_gdf = self.get_states_from_geometry(geom)
+        if len(counties_gdf) == 0:
+            logger.info("No counties intersect the geometry")
+            return [], counties_gdf
+
+        # the states to query are the states of the intersecting counties, so there is no need for
+        # a second spatial query against the state boundaries
+        state_fips = np.unique(counties_gdf["STATEFP"])
 
         """
         DATETIME: Produce a list of years that intersect with the datetime range 
@@ -126,58 +159,65 @@ class NASSQuickStats:
             start_year = datetime[0].year
             end_year = datetime[1].year
 
-            years_range = list(range(start_year, end_year + 1))
+            years_range = range(start_year, end_year + 1)
         else:
             logger.info("No datetime provided. Using 2023 as default.")
-            years_range = [2023]
+            years_range = range(2023, 2024)
 
         """
         FILTER:
         convert cql filter to query parameters and update
         """
+        filter_params = {}
         if filter:
             logger.info("Received CQL filter")
-            filter_params = cql2_to_query_params(filter)
-
-        query_list = []
-
-        for row_index, row in states_gdf.reset_index().iterrows():
-            query_params = {}
-
-            query_params.update(extra_params)
-
-            if self.api_default_params:
-                query_params.update(self.api_default_params)
-
-            # FIXME: account for the possibility that there is no county (state only)
-            query_params["state_fips_code"] = row["STATEFP"]
-            query_params["sector_desc"] = "CROPS"
-            query_params["agg_level_desc"] = "COUNTY"
-
-            if filter:
-                # FIXME: make sure this doesn't overwrite the other params, and that it consists only of valid params
-                query_params.update(filter_params)
+            filter_params = _cql2_to_query_params_cached(
+                orjson.dumps(filter, option=orjson.OPT_SORT_KEYS)
+            )
 
-            for year_index, year in enumerate(years_range):
-                query_params["year"] = year
-                # query_params["query_index"] = row_index * len(years_range) + year_index
-                query_list.append(query_params)
+        # a state_fips_code in the filter restricts the states to query rather than being replaced
+        # by the states from the geometry
+        filter_params = dict(filter_params)
+        filter_state_fips = filter_params.pop("state_fips_code", None)
+        if filter_state_fips is not None:
+            state_fips = state_fips[np.isin(state_fips, np.atleast_1d(filter_state_fips))]
+
+        # one query per (state, year), built from the cross product of states and years
+        n_states = len(state_fips)
+        n_years = len(years_range)
+        state_fips_codes = np.repeat(state_fips, n_years)
+        years = np.tile(np.arange(years_range.start, years_range.stop), n_states)
+
+        # params shared by every query; each query gets its own copy with the state and year
+        # FIXME: account for the possibility that there is no county (state only)
+        # FIXME: make sure filter_params doesn't overwrite the other params, and that it consists only of valid params
+        base_params = {
+            **extra_params,
+            **self.api_default_params,
+            "sector_desc": "CROPS",
+            "agg_level_desc": "COUNTY",
+            **filter_params,
+        }
+        query_list = [
+            {**base_params, "state_fips_code": state_fips_code, "year": int(year)}
+            for state_fips_code, year in zip(state_fips_codes, years)
+        ]
 
         return query_list, counties_gdf
 
-    @cached(cache=TTLCache(maxsize=1024, ttl=3600 * 24))
+    @cached(cache=TTLCache(maxsize=1024, ttl=3600 * 24), lock=threading.Lock())
     def _make_request(self, encoded_params: str) -> pd.DataFrame:
-        response = requests.get(f"{self.api_url}?{encoded_params}")
+        response = self.session.get(f"{self.api_url}?{encoded_params}", timeout=REQUEST_TIMEOUT)
 
         # Check if the request was successful (status code 200)
         if response.status_code == 200:
             # Parse and use the response data (JSON in this case)
-            res = response.json()
+            res = orjson.loads(response.content)
 
             # Check if the response is empty
             if not res:
                 logger.info("No results returned from API")
-                df = pd.DataFrame()
+                return pd.DataFrame()
 
             # Get number of results and the geometry from counties_gdf
             n_returned = len(res["data"])
@@ -189,6 +229,35 @@ class NASSQuickStats:
 
         return df
 
+    def _iter_requests(
+        self, query_list: List[dict], start_index: int
+    ) -> Iterator[Tuple[int, pd.DataFrame]]:
+        """
+        Yields (resource_index, df) for each query from start_index on, in order. The first query is
+        requested on its own, since it usually fills the page. Each further resource the page needs
+        doubles the number of queries requested ahead, up to MAX_CONCURRENT_REQUESTS. When the
+        caller stops early, queued requests are cancelled and in-flight ones are not waited on.
+        """
+        pending = deque()
+        next_index = start_index
+        window = 1
+        try:
+            while pending or next_index < len(query_list):
+                while next_index < len(query_list) and len(pending) < window:
+                    api_params = query_list[next_index]
+                    logger.info(f"Making request with params: {api_params}")
+                    encoded_params = urllib.parse.urlencode(api_params)
+                    future = self.executor.submit(self._make_request, encoded_params)
+                    pending.append((next_index, future))
+                    next_index += 1
+
+                resource_index, future = pending.popleft()
+                yield resource_index, future.result()
+                window = min(window * 2, MAX_CONCURRENT_REQUESTS)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
     def make_request(
         self, pagination={}, query_list=[], counties_gdf=None, **kwargs
     ) -> gpd.GeoDataFrame:
@@ -208,15 +277,11 @@ class NASSQuickStats:
 
         results_gdf = gpd.GeoDataFrame(columns=["geometry", "id"])
 
-        for resource_index in range(resource_index, len(query_list)):
-
-            api_params = query_list[resource_index]
-            logger.info(f"Making request with params: {api_params}")
-
-            # Make the request
-            encoded_params = urllib.parse.urlencode(api_params)
-            df = self._make_request(encoded_params)
+        for resource_index, df in self._iter_requests(query_list, resource_index):
             logger.info(f"len(df) from _make_request: {len(df)}")
+            if df.empty:
+                # nothing to join or append, and the offset is unchanged
+                continue
 
             joined_df = pd.merge(
                 df,